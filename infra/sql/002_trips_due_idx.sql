@@ -0,0 +1,8 @@
+-- scan_due_trips: WHERE next_calc_at <= now AND calc_state IN (...) ORDER BY next_calc_at LIMIT 50
+-- idx_trips_next_calc_at already gives the ordered range scan, but it also walks every queued/running
+-- trip with a past next_calc_at and filters it on the heap. The partial index holds only schedulable
+-- trips, so the scan reads just the rows it returns. The query must send the states as literals
+-- (see _SCHEDULABLE_STATES in the worker) or a generic prepared plan can't use this index.
+-- CONCURRENTLY so it can also be applied by hand on a live db: psql -f 002_trips_due_idx.sql
+CREATE INDEX CONCURRENTLY IF NOT EXISTS trips_due_idx ON trips (next_calc_at)
+  WHERE calc_state IN ('idle','done','budget_limited','error') AND next_calc_at IS NOT NULL;
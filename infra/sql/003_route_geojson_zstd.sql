@@ -0,0 +1,6 @@
+-- route geometry stored as zstd-compressed geojson (orjson bytes); route_geojson is left NULL
+-- for new recalcs and legacy rows are moved over on their next recalc.
+-- initdb only runs this on an empty volume. On an existing db apply it by hand:
+--   docker compose exec -T db psql -U delayshield -d delayshield < infra/sql/003_route_geojson_zstd.sql
+-- until then api/worker detect the missing column and keep using route_geojson.
+ALTER TABLE trips ADD COLUMN IF NOT EXISTS route_geojson_zstd BYTEA;
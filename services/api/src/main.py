@@ -1,13 +1,19 @@
-import os, uuid, asyncio
+import os, uuid, hashlib
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone, date
 from typing import Any, List, Optional
 
 import httpx
+import msgpack
+import orjson
+import redis.asyncio as aioredis
+import zstandard
 from fastapi import FastAPI, HTTPException, Response
-from pydantic import BaseModel, Field
-from sqlalchemy import create_engine, select, insert, update
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, Field, TypeAdapter
+from sqlalchemy import create_engine, select, insert, update, text
 from sqlalchemy.orm import sessionmaker, DeclarativeBase, Mapped, mapped_column
-from sqlalchemy import Text, Integer, DateTime, BigInteger, ForeignKey, Date
+from sqlalchemy import Text, Integer, DateTime, BigInteger, ForeignKey, Date, LargeBinary
 from sqlalchemy.dialects.postgresql import UUID, JSONB
 from sqlalchemy.sql import func
 from celery import Celery
@@ -17,13 +23,29 @@ DATABASE_URL = os.environ.get("DATABASE_URL")
 REDIS_URL = os.environ.get("REDIS_URL", "redis://redis:6379/0")
 OPENROUTESERVICE_API_KEY_FILE = os.environ.get("OPENROUTESERVICE_API_KEY_FILE", "/run/secrets/openrouteservice_api_key")
 OSRM_BASE_URL = os.environ.get("OSRM_BASE_URL", "https://router.project-osrm.org")
+ROUTE_CACHE_TTL_SECONDS = int(os.environ.get("ROUTE_CACHE_TTL_SECONDS", "3600"))
+
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", "10"))
+DB_POOL_RECYCLE_SECONDS = int(os.environ.get("DB_POOL_RECYCLE_SECONDS", "1800"))
 
 if not DATABASE_URL:
   raise RuntimeError("DATABASE_URL required")
 
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+engine = create_engine(
+  DATABASE_URL,
+  pool_pre_ping=True,
+  pool_size=DB_POOL_SIZE,
+  max_overflow=DB_MAX_OVERFLOW,
+  pool_recycle=DB_POOL_RECYCLE_SECONDS,
+  pool_use_lifo=True,
+  json_serializer=lambda o: orjson.dumps(o).decode(),
+  json_deserializer=orjson.loads,
+)
 Session = sessionmaker(bind=engine, autoflush=False, autocommit=False)
 celery = Celery("api-enqueue", broker=REDIS_URL, backend=REDIS_URL)
+rds = aioredis.Redis.from_url(REDIS_URL)
+http_client: Optional[httpx.AsyncClient] = None
 
 REQS = Counter("api_requests_total", "API requests", ["path", "method", "code"])
 LAT = Histogram("api_request_seconds", "API latency", ["path"])
@@ -52,6 +74,7 @@ class Trip(Base):
   route_distance_m: Mapped[int] = mapped_column(Integer, nullable=True)
   route_duration_s: Mapped[int] = mapped_column(Integer, nullable=True)
   route_geojson: Mapped[dict] = mapped_column(JSONB, nullable=True)
+  route_geojson_zstd: Mapped[bytes] = mapped_column(LargeBinary, nullable=True)
 
   buffer_minutes: Mapped[int] = mapped_column(Integer, nullable=True)
   delay_risk_pct: Mapped[int] = mapped_column(Integer, nullable=True)
@@ -137,7 +160,21 @@ class TripWithHistory(BaseModel):
   updates: list[dict]
   usage_today: dict
 
-app = FastAPI(title="DelayShield API", version="4.0.0")
+@asynccontextmanager
+async def _lifespan(app: FastAPI):
+  global http_client
+  http_client = httpx.AsyncClient(
+    http2=True,
+    timeout=httpx.Timeout(25.0, connect=5.0),
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60),
+  )
+  try:
+    yield
+  finally:
+    await http_client.aclose()
+    await rds.aclose()
+
+app = FastAPI(title="DelayShield API", version="4.0.0", default_response_class=ORJSONResponse, lifespan=_lifespan)
 
 @app.middleware("http")
 async def metrics_mw(request, call_next):
@@ -156,54 +193,68 @@ def metrics():
 def health():
   return {"ok": True}
 
-async def _route_from_waypoints(waypoints: list[Waypoint]) -> dict:
+def _route_cache_key(coords: list[list[float]]) -> str:
+  # shared with the worker: same quantization, same key
+  q = [(round(c[0], 4), round(c[1], 4)) for c in coords]
+  return "route:" + hashlib.blake2b(orjson.dumps(q)).hexdigest()
+
+async def _route_from_waypoints(client: httpx.AsyncClient, waypoints: list[Waypoint]) -> dict:
   coords = [[w.lon, w.lat] for w in waypoints]
-  ors = _read_secret(OPENROUTESERVICE_API_KEY_FILE)
+  key = _route_cache_key(coords)
+  raw = await rds.get(key)
+  if raw is not None:
+    dist_m, dur_s, geom, _ = msgpack.unpackb(raw)
+    return {"distance_m": dist_m, "duration_s": dur_s, "geometry": geom, "provider":"cache"}
 
-  async with httpx.AsyncClient(timeout=25) as client:
-    if ors:
-      resp = await client.post(
-        "https://api.openrouteservice.org/v2/directions/driving-car/geojson",
-        headers={"Authorization": ors, "Content-Type":"application/json"},
-        json={"coordinates": coords},
-      )
-      resp.raise_for_status()
-      data = resp.json()
-      feat = data["features"][0]
-      s = feat["properties"]["summary"]
-      return {"distance_m": int(s["distance"]), "duration_s": int(s["duration"]), "geometry": feat["geometry"], "provider":"ors"}
-    else:
-      path = ";".join([f"{w.lon},{w.lat}" for w in waypoints])
-      resp = await client.get(f"{OSRM_BASE_URL}/route/v1/driving/{path}", params={"overview":"full","geometries":"geojson"})
-      resp.raise_for_status()
-      data = resp.json()
-      r = data["routes"][0]
-      return {"distance_m": int(r["distance"]), "duration_s": int(r["duration"]), "geometry": r["geometry"], "provider":"osrm"}
+  out = await _fetch_route(client, waypoints, coords)
+  await rds.setex(key, ROUTE_CACHE_TTL_SECONDS, msgpack.packb((out["distance_m"], out["duration_s"], out["geometry"], out["provider"])))
+  return out
+
+async def _fetch_route(client: httpx.AsyncClient, waypoints: list[Waypoint], coords: list[list[float]]) -> dict:
+  ors = _read_secret(OPENROUTESERVICE_API_KEY_FILE)
+  if ors:
+    resp = await client.post(
+      "https://api.openrouteservice.org/v2/directions/driving-car/geojson",
+      headers={"Authorization": ors, "Content-Type":"application/json"},
+      json={"coordinates": coords},
+    )
+    resp.raise_for_status()
+    data = orjson.loads(resp.content)
+    feat = data["features"][0]
+    s = feat["properties"]["summary"]
+    return {"distance_m": int(s["distance"]), "duration_s": int(s["duration"]), "geometry": feat["geometry"], "provider":"ors"}
+  else:
+    path = ";".join([f"{w.lon},{w.lat}" for w in waypoints])
+    resp = await client.get(f"{OSRM_BASE_URL}/route/v1/driving/{path}", params={"overview":"full","geometries":"geojson"})
+    resp.raise_for_status()
+    data = orjson.loads(resp.content)
+    r = data["routes"][0]
+    return {"distance_m": int(r["distance"]), "duration_s": int(r["duration"]), "geometry": r["geometry"], "provider":"osrm"}
 
 def _push_update(db, trip_id: uuid.UUID, kind: str, payload: dict):
   db.execute(insert(TripUpdate).values(trip_id=trip_id, kind=kind, payload=payload))
 
-def _to_out(t: Trip) -> TripOut:
-  wps = [Waypoint(**p) for p in (t.waypoints.get("points") or [])]
-  return TripOut(
-    id=t.id, created_at=t.created_at, updated_at=t.updated_at,
-    deadline_at=t.deadline_at, waypoints=wps,
-    eta_at=t.eta_at, route_distance_m=t.route_distance_m, route_duration_s=t.route_duration_s,
-    buffer_minutes=t.buffer_minutes, delay_risk_pct=t.delay_risk_pct, status=t.status, suggestion=t.suggestion,
-    recommended_depart_at=t.recommended_depart_at, why=t.why, customer_message=t.customer_message,
-    policy_mode=t.policy_mode, trip_owm_daily_cap=t.trip_owm_daily_cap, trip_route_daily_cap=t.trip_route_daily_cap,
-    next_calc_at=t.next_calc_at, last_calc_at=t.last_calc_at, calc_state=t.calc_state
-  )
+# Core column list for TripOut (no route_geojson): rows come back as plain mappings, no ORM identity map
+_TRIP_COLS = [Trip.__table__.c[name] for name in TripOut.model_fields]
+_TRIPOUT_ADAPTER = TypeAdapter(list[TripOut])
+
+def _load_trip(db, trip_id: uuid.UUID):
+  return db.execute(select(*_TRIP_COLS).where(Trip.id == trip_id)).mappings().first()
+
+def _to_out(row) -> TripOut:
+  # rows come from our own table: skip validation
+  fields = dict(row)
+  fields["waypoints"] = [Waypoint.model_construct(**p) for p in (row["waypoints"].get("points") or [])]
+  return TripOut.model_construct(**fields)
 
 def _validate_mode(m: str):
   if m not in ("conservative","balanced","aggressive"):
     raise HTTPException(status_code=400, detail="policy_mode must be conservative|balanced|aggressive")
 
 @app.post("/api/route/preview")
-def route_preview(body: RoutePreviewIn):
+async def route_preview(body: RoutePreviewIn):
   try:
-    out = asyncio.run(_route_from_waypoints(body.waypoints))
-    return out
+    return await _route_from_waypoints(http_client, body.waypoints)
   except Exception as e:
     raise HTTPException(status_code=400, detail=str(e))
 
@@ -211,11 +262,11 @@ def route_preview(body: RoutePreviewIn):
 def create_trip(body: TripCreateIn):
   _validate_mode(body.policy_mode)
   tid = uuid.uuid4()
-  wp_payload = {"points": [w.model_dump() for w in body.waypoints]}
+  wp_payload = {"points": [{"lat": w.lat, "lon": w.lon} for w in body.waypoints]}
   now = datetime.now(timezone.utc)
 
   with Session() as db:
-    db.execute(insert(Trip).values(
+    row = db.execute(insert(Trip).values(
       id=tid,
       deadline_at=body.deadline_at,
       waypoints=wp_payload,
@@ -224,39 +275,69 @@ def create_trip(body: TripCreateIn):
       trip_route_daily_cap=int(body.trip_route_daily_cap),
       next_calc_at=now,
       calc_state="queued",
-    ))
-    _push_update(db, tid, "created", {"deadline_at": body.deadline_at.isoformat(), "waypoints_n": len(body.waypoints), "policy_mode": body.policy_mode})
-    _push_update(db, tid, "recalc_queued", {"by":"create"})
+    ).returning(*_TRIP_COLS)).mappings().one()
+    db.execute(insert(TripUpdate), [
+      {"trip_id": tid, "kind": "created", "payload": {"deadline_at": body.deadline_at.isoformat(), "waypoints_n": len(body.waypoints), "policy_mode": body.policy_mode}},
+      {"trip_id": tid, "kind": "recalc_queued", "payload": {"by":"create"}},
+    ])
     db.commit()
 
   celery.send_task("worker.tasks.recalc_trip", args=[str(tid)])
-
-  with Session() as db:
-    t = db.scalar(select(Trip).where(Trip.id == tid))
-    return _to_out(t)
+  return _to_out(row)
 
 @app.get("/api/trips", response_model=list[TripOut])
 def list_trips():
   with Session() as db:
-    rows = db.scalars(select(Trip).order_by(Trip.created_at.desc())).all()
-    return [_to_out(t) for t in rows]
+    rows = db.execute(select(*_TRIP_COLS).order_by(Trip.created_at.desc())).mappings()
+    out = [_to_out(r) for r in rows]
+  return Response(_TRIPOUT_ADAPTER.dump_json(out), media_type="application/json")
 
 @app.get("/api/trips/{trip_id}", response_model=TripWithHistory)
 def get_trip(trip_id: uuid.UUID):
   today = date.today()
   with Session() as db:
-    t = db.scalar(select(Trip).where(Trip.id == trip_id))
+    t = _load_trip(db, trip_id)
     if not t: raise HTTPException(status_code=404, detail="not found")
-    ups = db.execute(select(TripUpdate).where(TripUpdate.trip_id==trip_id).order_by(TripUpdate.at.desc()).limit(60)).scalars().all()
-    u = db.scalar(select(TripApiUsageDaily).where(TripApiUsageDaily.trip_id==trip_id, TripApiUsageDaily.day==today))
+    tu = TripUpdate.__table__.c
+    ups = db.execute(select(tu.id, tu.at, tu.kind, tu.payload).where(tu.trip_id==trip_id).order_by(tu.at.desc()).limit(60)).mappings().all()
+    uc = TripApiUsageDaily.__table__.c
+    u = db.execute(select(uc.owm_calls, uc.route_calls).where(uc.trip_id==trip_id, uc.day==today)).first()
     usage = {"owm_calls": (u.owm_calls if u else 0), "route_calls": (u.route_calls if u else 0),
-             "owm_cap": t.trip_owm_daily_cap, "route_cap": t.trip_route_daily_cap}
-    return {"trip": _to_out(t), "updates": [{"id":u2.id,"at":u2.at,"kind":u2.kind,"payload":u2.payload or {}} for u2 in ups], "usage_today": usage}
+             "owm_cap": t["trip_owm_daily_cap"], "route_cap": t["trip_route_daily_cap"]}
+    return {"trip": _to_out(t), "updates": [{"id":u2["id"],"at":u2["at"],"kind":u2["kind"],"payload":u2["payload"] or {}} for u2 in ups], "usage_today": usage}
+
+_ZSTD_COL_READY = False
+
+def _has_zstd_col(db) -> bool:
+  # upgraded dbs may not have run infra/sql/003 yet: serve route_geojson until they do
+  global _ZSTD_COL_READY
+  if not _ZSTD_COL_READY:
+    _ZSTD_COL_READY = db.execute(text(
+      "SELECT 1 FROM information_schema.columns"
+      " WHERE table_schema = current_schema() AND table_name = 'trips' AND column_name = 'route_geojson_zstd'"
+    )).first() is not None
+  return _ZSTD_COL_READY
+
+@app.get("/api/trips/{trip_id}/geometry")
+def get_trip_geometry(trip_id: uuid.UUID):
+  with Session() as db:
+    if _has_zstd_col(db):
+      g = db.execute(select(Trip.route_geojson_zstd, Trip.route_geojson).where(Trip.id==trip_id)).first()
+    else:
+      g = db.execute(select(Trip.route_geojson).where(Trip.id==trip_id)).first()
+  if not g: raise HTTPException(status_code=404, detail="not found")
+  blob = g._mapping.get("route_geojson_zstd")
+  if blob is not None:
+    # stored as orjson bytes: decompress straight into the response body, no parse
+    return Response(zstandard.ZstdDecompressor().decompress(blob), media_type="application/json")
+  if g.route_geojson is not None:
+    return g.route_geojson
+  raise HTTPException(status_code=404, detail="route not computed yet")
 
 @app.post("/api/trips/{trip_id}/recalc", response_model=TripOut)
 def recalc_now(trip_id: uuid.UUID):
   with Session() as db:
-    t = db.scalar(select(Trip).where(Trip.id==trip_id))
+    t = db.scalar(select(Trip.id).where(Trip.id==trip_id))
     if not t: raise HTTPException(status_code=404, detail="not found")
     db.execute(update(Trip).where(Trip.id==trip_id).values(calc_state="queued", next_calc_at=datetime.now(timezone.utc)))
     _push_update(db, trip_id, "recalc_queued", {"by":"user"})
@@ -265,13 +346,12 @@ def recalc_now(trip_id: uuid.UUID):
   celery.send_task("worker.tasks.recalc_trip", args=[str(trip_id)])
 
   with Session() as db:
-    t2 = db.scalar(select(Trip).where(Trip.id==trip_id))
-    return _to_out(t2)
+    return _to_out(_load_trip(db, trip_id))
 
 @app.patch("/api/trips/{trip_id}/policy", response_model=TripOut)
 def patch_policy(trip_id: uuid.UUID, body: TripPolicyPatch):
   with Session() as db:
-    t = db.scalar(select(Trip).where(Trip.id==trip_id))
+    t = _load_trip(db, trip_id)
     if not t: raise HTTPException(status_code=404, detail="not found")
     vals = {}
     if body.policy_mode is not None:
@@ -287,5 +367,4 @@ def patch_policy(trip_id: uuid.UUID, body: TripPolicyPatch):
     _push_update(db, trip_id, "policy_updated", vals)
     db.commit()
   with Session() as db:
-    t2 = db.scalar(select(Trip).where(Trip.id==trip_id))
-    return _to_out(t2)
+    return _to_out(_load_trip(db, trip_id))
@@ -0,0 +1,8 @@
+from math import asin, cos, radians, sin, sqrt
+
+EARTH_RADIUS_M = 6_371_000.0
+
+def haversine_m(lon1: float, lat1: float, lon2: float, lat2: float) -> float:
+  p1, p2 = radians(lat1), radians(lat2)
+  a = sin((p2 - p1) / 2.0) ** 2 + cos(p1) * cos(p2) * sin(radians(lon2 - lon1) / 2.0) ** 2
+  return EARTH_RADIUS_M * 2.0 * asin(sqrt(a))
@@ -1,14 +1,22 @@
-import os, uuid, asyncio
+import os, uuid, asyncio, hashlib, bisect
 from datetime import datetime, timezone, timedelta, date
 
 import httpx
-from celery import Celery
-from sqlalchemy import create_engine, select, update, insert
+import msgpack
+import orjson
+import redis
+import zstandard
+from celery import Celery, group
+from celery.signals import worker_process_init
+from celery.utils.log import get_task_logger
+from sqlalchemy import create_engine, select, update, insert, text, bindparam
 from sqlalchemy.orm import sessionmaker, DeclarativeBase, Mapped, mapped_column
-from sqlalchemy import Text, Integer, DateTime, BigInteger, ForeignKey, Date
+from sqlalchemy import Text, Integer, DateTime, BigInteger, ForeignKey, Date, LargeBinary
 from sqlalchemy.dialects.postgresql import UUID, JSONB
 from sqlalchemy.sql import func
 
+from .geo import haversine_m
+
 REDIS_URL = os.environ.get("REDIS_URL", "redis://redis:6379/0")
 DATABASE_URL = os.environ.get("DATABASE_URL")
 OPENWEATHER_API_KEY_FILE = os.environ.get("OPENWEATHER_API_KEY_FILE", "/run/secrets/openweather_api_key")
@@ -20,13 +28,49 @@ ROUTE_DAILY_LIMIT = int(os.environ.get("ROUTE_DAILY_LIMIT", "400"))
 OWM_PER_MIN_LIMIT = int(os.environ.get("OWM_PER_MIN_LIMIT", "30"))
 ROUTE_PER_MIN_LIMIT = int(os.environ.get("ROUTE_PER_MIN_LIMIT", "20"))
 SCAN_INTERVAL_SECONDS = int(os.environ.get("SCAN_INTERVAL_SECONDS", "60"))
+ROUTE_CACHE_TTL_SECONDS = int(os.environ.get("ROUTE_CACHE_TTL_SECONDS", "3600"))
+FORECAST_CACHE_TTL_SECONDS = int(os.environ.get("FORECAST_CACHE_TTL_SECONDS", "900"))
+SHORT_TRIP_MAX_M = float(os.environ.get("SHORT_TRIP_MAX_M", "500"))
+SHORT_TRIP_SPEED_MPS = float(os.environ.get("SHORT_TRIP_SPEED_MPS", "8.0"))  # ~30 km/h city
+RECALC_BATCH_SIZE = int(os.environ.get("RECALC_BATCH_SIZE", "10"))
+RECALC_BATCH_CONCURRENCY = int(os.environ.get("RECALC_BATCH_CONCURRENCY", "8"))
+RECALC_ERROR_RETRY_SECONDS = int(os.environ.get("RECALC_ERROR_RETRY_SECONDS", "900"))
+
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", "10"))
+DB_POOL_RECYCLE_SECONDS = int(os.environ.get("DB_POOL_RECYCLE_SECONDS", "1800"))
 
 if not DATABASE_URL:
   raise RuntimeError("DATABASE_URL required")
 
 celery = Celery("worker", broker=REDIS_URL, backend=REDIS_URL)
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+logger = get_task_logger(__name__)
+# recalc is IO-bound (ORS/OWM/Postgres waits): run more children than cores and hand each
+# one task at a time so a slow recalc doesn't hold prefetched messages hostage
+celery.conf.update(
+  worker_concurrency=int(os.environ.get("CELERY_WORKER_CONCURRENCY", "16")),
+  worker_prefetch_multiplier=1,
+  broker_pool_limit=int(os.environ.get("CELERY_BROKER_POOL_LIMIT", "50")),
+  task_acks_late=True,
+  worker_send_task_events=False,
+)
+engine = create_engine(
+  DATABASE_URL,
+  pool_pre_ping=True,
+  pool_size=DB_POOL_SIZE,
+  max_overflow=DB_MAX_OVERFLOW,
+  pool_recycle=DB_POOL_RECYCLE_SECONDS,
+  pool_use_lifo=True,
+  json_serializer=lambda o: orjson.dumps(o).decode(),
+  json_deserializer=orjson.loads,
+)
 Session = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+rds = redis.Redis.from_url(REDIS_URL)
+
+# one loop + http client per worker process: set up in worker_process_init (after fork),
+# lazily otherwise (solo pool / eager calls)
+_LOOP: asyncio.AbstractEventLoop | None = None
+_HTTP: httpx.AsyncClient | None = None
 
 class Base(DeclarativeBase): pass
 
@@ -40,6 +84,7 @@ class Trip(Base):
   route_distance_m: Mapped[int] = mapped_column(Integer, nullable=True)
   route_duration_s: Mapped[int] = mapped_column(Integer, nullable=True)
   route_geojson: Mapped[dict] = mapped_column(JSONB, nullable=True)
+  route_geojson_zstd: Mapped[bytes] = mapped_column(LargeBinary, nullable=True)
 
   buffer_minutes: Mapped[int] = mapped_column(Integer, nullable=True)
   delay_risk_pct: Mapped[int] = mapped_column(Integer, nullable=True)
@@ -79,12 +124,6 @@ class ApiUsageDaily(Base):
   day: Mapped[date] = mapped_column(Date, primary_key=True)
   calls: Mapped[int] = mapped_column(Integer, nullable=False, server_default="0")
 
-class ApiUsageMinute(Base):
-  __tablename__ = "api_usage_minute"
-  api_name: Mapped[str] = mapped_column(Text, primary_key=True)
-  minute_bucket: Mapped[object] = mapped_column(DateTime(timezone=True), primary_key=True)
-  calls: Mapped[int] = mapped_column(Integer, nullable=False, server_default="0")
-
 def _read_secret(path: str) -> str | None:
   try:
     with open(path, "r", encoding="utf-8") as f:
@@ -93,25 +132,73 @@ def _read_secret(path: str) -> str | None:
   except FileNotFoundError:
     return None
 
+def _new_http() -> httpx.AsyncClient:
+  return httpx.AsyncClient(
+    http2=True,
+    timeout=httpx.Timeout(25.0, connect=5.0),
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60),
+  )
+
+@worker_process_init.connect
+def _init_process(**_):
+  global _LOOP, _HTTP
+  _LOOP = asyncio.new_event_loop()
+  asyncio.set_event_loop(_LOOP)
+  _HTTP = _new_http()
+
+def _run(coro):
+  global _LOOP
+  if _LOOP is None:
+    _LOOP = asyncio.new_event_loop()
+    asyncio.set_event_loop(_LOOP)
+  return _LOOP.run_until_complete(coro)
+
+def _http() -> httpx.AsyncClient:
+  global _HTTP
+  if _HTTP is None:
+    _HTTP = _new_http()
+  return _HTTP
+
 def _minute_bucket(dt: datetime) -> datetime:
   return dt.replace(second=0, microsecond=0)
 
-def _ensure_usage_row_daily(db, api_name: str, d: date):
-  row = db.scalar(select(ApiUsageDaily).where(ApiUsageDaily.api_name==api_name, ApiUsageDaily.day==d))
-  if not row:
-    db.execute(insert(ApiUsageDaily).values(api_name=api_name, day=d, calls=0))
-
-def _ensure_usage_row_minute(db, api_name: str, mb: datetime):
-  row = db.scalar(select(ApiUsageMinute).where(ApiUsageMinute.api_name==api_name, ApiUsageMinute.minute_bucket==mb))
-  if not row:
-    db.execute(insert(ApiUsageMinute).values(api_name=api_name, minute_bucket=mb, calls=0))
-
-def _ensure_trip_usage_daily(db, trip_id: uuid.UUID, d: date):
-  row = db.scalar(select(TripApiUsageDaily).where(TripApiUsageDaily.trip_id==trip_id, TripApiUsageDaily.day==d))
-  if not row:
-    db.execute(insert(TripApiUsageDaily).values(trip_id=trip_id, day=d, owm_calls=0, route_calls=0))
-
-def _consume_budget(db, trip: Trip, api_name: str, kind: str, amount: int = 1) -> tuple[bool, str]:
+# daily counters: one round trip. Each CTE upserts its counter only if it stays within the
+# limit, so an empty RETURNING means "denied". The outer SELECT still sees the pre-statement
+# snapshot, which gives the current counts for the denial reason.
+_BUDGET_SQL = """
+WITH gd AS (
+  INSERT INTO api_usage_daily AS u (api_name, day, calls)
+  SELECT :api, CAST(:day AS date), :n WHERE :n <= :daily_limit
+  ON CONFLICT (api_name, day) DO UPDATE SET calls = u.calls + :n
+  WHERE u.calls + :n <= :daily_limit
+  RETURNING u.calls
+), tu AS (
+  INSERT INTO trip_api_usage_daily AS u (trip_id, day, {col})
+  SELECT CAST(:trip_id AS uuid), CAST(:day AS date), :n WHERE :n <= :trip_cap
+  ON CONFLICT (trip_id, day) DO UPDATE SET {col} = u.{col} + :n
+  WHERE u.{col} + :n <= :trip_cap
+  RETURNING u.{col} AS calls
+)
+SELECT
+  (SELECT calls FROM gd) AS gd_calls,
+  (SELECT calls FROM tu) AS tu_calls,
+  (SELECT calls FROM api_usage_daily WHERE api_name = :api AND day = CAST(:day AS date)) AS gd_prev,
+  (SELECT {col} FROM trip_api_usage_daily WHERE trip_id = CAST(:trip_id AS uuid) AND day = CAST(:day AS date)) AS tu_prev
+"""
+_BUDGET_STMTS = {api: text(_BUDGET_SQL.format(col=f"{api}_calls")) for api in ("owm", "route")}
+
+# per-minute counters live in redis: returns the new count (> 0) if allowed, otherwise
+# -(current count) with the counter left untouched. EXPIRE comes first so no key is left without a TTL.
+_PER_MIN_INCR = rds.register_script("""
+local v = redis.call('INCRBY', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[1], 90)
+if v > tonumber(ARGV[2]) then
+  return -redis.call('DECRBY', KEYS[1], ARGV[1])
+end
+return v
+""")
+
+def _consume_budget(db, trip, api_name: str, kind: str, amount: int = 1) -> tuple[bool, str]:
   now = datetime.now(timezone.utc)
   d = date.today()
   mb = _minute_bucket(now)
@@ -125,88 +212,108 @@ def _consume_budget(db, trip: Trip, api_name: str, kind: str, amount: int = 1) -
     per_min = ROUTE_PER_MIN_LIMIT
     trip_cap = int(trip.trip_route_daily_cap)
 
-  _ensure_usage_row_daily(db, api_name, d)
-  _ensure_usage_row_minute(db, api_name, mb)
-  _ensure_trip_usage_daily(db, trip.id, d)
-  db.commit()
-
-  gd = db.scalar(select(ApiUsageDaily).where(ApiUsageDaily.api_name==api_name, ApiUsageDaily.day==d).with_for_update())
-  gm = db.scalar(select(ApiUsageMinute).where(ApiUsageMinute.api_name==api_name, ApiUsageMinute.minute_bucket==mb).with_for_update())
-  tu = db.scalar(select(TripApiUsageDaily).where(TripApiUsageDaily.trip_id==trip.id, TripApiUsageDaily.day==d).with_for_update())
-
-  if gd.calls + amount > daily_limit:
-    return (False, f"global_daily_limit {api_name} {gd.calls}/{daily_limit}")
-  if gm.calls + amount > per_min:
-    return (False, f"per_min_limit {api_name} {gm.calls}/{per_min} bucket={mb.isoformat()}")
-  if api_name == "owm" and (tu.owm_calls + amount > trip_cap):
-    return (False, f"trip_daily_cap owm {tu.owm_calls}/{trip_cap}")
-  if api_name == "route" and (tu.route_calls + amount > trip_cap):
-    return (False, f"trip_daily_cap route {tu.route_calls}/{trip_cap}")
-
-  gd.calls += amount
-  gm.calls += amount
-  if api_name == "owm": tu.owm_calls += amount
-  else: tu.route_calls += amount
-  db.commit()
+  r = db.execute(_BUDGET_STMTS[api_name], {
+    "api": api_name, "day": d, "trip_id": trip.id, "n": amount,
+    "daily_limit": daily_limit, "trip_cap": trip_cap,
+  }).one()
+
+  reason = None
+  if r.gd_calls is None:
+    reason = f"global_daily_limit {api_name} {r.gd_prev or 0}/{daily_limit}"
+  elif r.tu_calls is None:
+    reason = f"trip_daily_cap {api_name} {r.tu_prev or 0}/{trip_cap}"
+  elif (pm := _PER_MIN_INCR(keys=[f"{api_name}:min:{mb.isoformat()}"], args=[amount, per_min])) <= 0:
+    reason = f"per_min_limit {api_name} {-pm}/{per_min} bucket={mb.isoformat()}"
+  if reason:
+    db.rollback()
+    return (False, reason)
 
   db.execute(insert(TripUpdate).values(trip_id=trip.id, kind="budget_consume", payload={"api": api_name, "kind": kind, "amount": amount}))
   db.commit()
   return (True, "ok")
 
+def _route_cache_key(coords: list[list[float]]) -> str:
+  # ~11m grid: nearby clicks on the map for the same corridor share one entry (same key as the api)
+  q = [(round(c[0], 4), round(c[1], 4)) for c in coords]
+  return "route:" + hashlib.blake2b(orjson.dumps(q)).hexdigest()
+
+def _route_cache_get(coords: list[list[float]]):
+  raw = rds.get(_route_cache_key(coords))
+  if raw is None:
+    return None
+  dist_m, dur_s, geom, _ = msgpack.unpackb(raw)
+  return dist_m, dur_s, geom, "cache"
+
 async def _route(coords: list[list[float]]):
+  out = await _route_fetch(coords)
+  rds.setex(_route_cache_key(coords), ROUTE_CACHE_TTL_SECONDS, msgpack.packb(out))
+  return out
+
+async def _route_fetch(coords: list[list[float]]):
+  client = _http()
   ors = _read_secret(OPENROUTESERVICE_API_KEY_FILE)
-  async with httpx.AsyncClient(timeout=25) as client:
-    if ors:
-      resp = await client.post(
-        "https://api.openrouteservice.org/v2/directions/driving-car/geojson",
-        headers={"Authorization": ors, "Content-Type":"application/json"},
-        json={"coordinates": coords},
-      )
-      resp.raise_for_status()
-      data = resp.json()
-      feat = data["features"][0]
-      s = feat["properties"]["summary"]
-      return int(s["distance"]), int(s["duration"]), feat["geometry"], "ors"
-    path = ";".join([f"{c[0]},{c[1]}" for c in coords])
-    resp = await client.get(f"{OSRM_BASE_URL}/route/v1/driving/{path}", params={"overview":"full","geometries":"geojson"})
+  if ors:
+    resp = await client.post(
+      "https://api.openrouteservice.org/v2/directions/driving-car/geojson",
+      headers={"Authorization": ors, "Content-Type":"application/json"},
+      json={"coordinates": coords},
+    )
     resp.raise_for_status()
-    data = resp.json()
-    r = data["routes"][0]
-    return int(r["distance"]), int(r["duration"]), r["geometry"], "osrm"
+    data = orjson.loads(resp.content)
+    feat = data["features"][0]
+    s = feat["properties"]["summary"]
+    return int(s["distance"]), int(s["duration"]), feat["geometry"], "ors"
+  path = ";".join([f"{c[0]},{c[1]}" for c in coords])
+  resp = await client.get(f"{OSRM_BASE_URL}/route/v1/driving/{path}", params={"overview":"full","geometries":"geojson"})
+  resp.raise_for_status()
+  data = orjson.loads(resp.content)
+  r = data["routes"][0]
+  return int(r["distance"]), int(r["duration"]), r["geometry"], "osrm"
+
+def _severity(rain: float, snow: float, wind: float, clouds: float) -> float:
+  sev = min(1.0, rain/10.0)*0.5 + min(1.0, snow/5.0)*0.6 + min(1.0, wind/15.0)*0.4 + (clouds/100.0)*0.1
+  return max(0.0, min(1.0, sev))
+
+def _forecast_cache_key(lat: float, lon: float, eta_dt: datetime) -> str:
+  # ~1km grid + ETA hour: trips ending at the same hub share one OWM call
+  eta_h = eta_dt.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+  return f"owm:{round(lat, 2)}:{round(lon, 2)}:{eta_h.isoformat()}"
+
+def _forecast_cache_get(lat: float, lon: float, eta_dt: datetime):
+  raw = rds.get(_forecast_cache_key(lat, lon, eta_dt))
+  if raw is None:
+    return None
+  sev, wx = msgpack.unpackb(raw)
+  return sev, {**wx, "cached": True}
 
 async def _forecast(lat: float, lon: float, eta_dt: datetime):
+  sev, wx = await _forecast_fetch(lat, lon, eta_dt)
+  rds.setex(_forecast_cache_key(lat, lon, eta_dt), FORECAST_CACHE_TTL_SECONDS, msgpack.packb((sev, wx)))
+  return sev, wx
+
+async def _forecast_fetch(lat: float, lon: float, eta_dt: datetime):
   key = _read_secret(OPENWEATHER_API_KEY_FILE)
   if not key:
     raise RuntimeError("OpenWeather key missing")
-  async with httpx.AsyncClient(timeout=25) as client:
-    resp = await client.get(
-      "https://api.openweathermap.org/data/2.5/forecast",
-      params={"lat": lat, "lon": lon, "appid": key, "units":"metric"},
-    )
-    resp.raise_for_status()
-    data = resp.json()
-
-  best = None; best_diff = None
-  for item in data.get("list", []):
-    dt = datetime.fromtimestamp(item["dt"], tz=timezone.utc)
-    diff = abs((dt - eta_dt).total_seconds())
-    if best is None or diff < best_diff:
-      best, best_diff = item, diff
-  if not best:
+  resp = await _http().get(
+    "https://api.openweathermap.org/data/2.5/forecast",
+    params={"lat": lat, "lon": lon, "appid": key, "units":"metric"},
+  )
+  resp.raise_for_status()
+  data = orjson.loads(resp.content)
+
+  items = data.get("list") or []
+  if not items:
     return 0.0, {"summary":"no-forecast", "severity":0.0}
+  eta_ts = eta_dt.timestamp()
+  best = min(items, key=lambda x: abs(x["dt"] - eta_ts))
 
   wind = float(best.get("wind", {}).get("speed", 0.0))
   rain = float(best.get("rain", {}).get("3h", 0.0) or 0.0)
   snow = float(best.get("snow", {}).get("3h", 0.0) or 0.0)
   clouds = float(best.get("clouds", {}).get("all", 0.0))
   wx = (best.get("weather") or [{}])[0].get("main", "Unknown")
-
-  sev = 0.0
-  sev += min(1.0, rain/10.0) * 0.5
-  sev += min(1.0, snow/5.0) * 0.6
-  sev += min(1.0, wind/15.0) * 0.4
-  sev += (clouds/100.0) * 0.1
-  sev = max(0.0, min(1.0, sev))
+  sev = _severity(rain, snow, wind, clouds)
 
   return sev, {
     "severity": sev,
@@ -218,18 +325,26 @@ async def _forecast(lat: float, lon: float, eta_dt: datetime):
     "forecast_dt": datetime.fromtimestamp(best["dt"], tz=timezone.utc).isoformat()
   }
 
+# slack thresholds (s) -> base risk; bisect_right keeps the ">=" boundaries of the old ternary chain
+_RISK_SLACK_THRESH = [-2*3600, 0, 2*3600, 4*3600]
+_RISK_BASE = [0.85, 0.70, 0.40, 0.20, 0.10]
+_STATUS = ("🟢", "🟡", "🔴")
+_SUGGESTION = (
+  "Manter rota. Recalcular mais perto do prazo.",
+  "Considere antecipar saída e avisar cliente sobre possível variação.",
+  "ALTO risco: antecipar/alternar rota e ALERTAR cliente agora.",
+)
+
 def _risk(deadline: datetime, eta: datetime, sev: float):
   slack_s = (deadline - eta).total_seconds()
-  base = 0.10 if slack_s >= 4*3600 else (0.20 if slack_s >= 2*3600 else (0.40 if slack_s >= 0 else (0.70 if slack_s >= -2*3600 else 0.85)))
+  base = _RISK_BASE[bisect.bisect_right(_RISK_SLACK_THRESH, slack_s)]
   risk = min(0.99, max(0.0, base + 0.25*sev))
   pct = int(round(risk*100))
-  status = "🟢" if pct < 34 else ("🟡" if pct < 67 else "🔴")
+  level = (pct >= 34) + (pct >= 67)
+  status = _STATUS[level]
   buffer_minutes = int(round(slack_s/60.0))
   why = f"buffer={buffer_minutes}min, weather_sev={sev:.2f}"
-  if status == "🟢": sugg = "Manter rota. Recalcular mais perto do prazo."
-  elif status == "🟡": sugg = "Considere antecipar saída e avisar cliente sobre possível variação."
-  else: sugg = "ALTO risco: antecipar/alternar rota e ALERTAR cliente agora."
-  return pct, status, buffer_minutes, why, sugg
+  return pct, status, buffer_minutes, why, _SUGGESTION[level]
 
 def _recommend_depart(now: datetime, status: str, buffer_minutes: int):
   if status == "🟢": return now
@@ -250,128 +365,212 @@ def _next_interval_seconds(mode: str, status: str, budget_limited: bool):
     return 20*60 if status=="🟢" else (8*60 if status=="🟡" else 2*60)
   return 40*60 if status=="🟢" else (15*60 if status=="🟡" else 5*60)
 
+# rendered as literals (not binds) so the planner can match trips_due_idx's partial predicate
+# even once psycopg auto-prepares the statement and postgres switches to a generic plan
+_SCHEDULABLE_STATES = bindparam("schedulable_states", ["idle","done","budget_limited","error"], expanding=True, literal_execute=True)
+
 @celery.task(name="worker.tasks.scan_due_trips")
 def scan_due_trips():
   now = datetime.now(timezone.utc)
+  # rows stay locked until the commit below; concurrent scanners skip them and take the next 50
   with Session() as db:
     rows = db.scalars(
-      select(Trip).where(
+      select(Trip.id).where(
         Trip.next_calc_at.isnot(None),
         Trip.next_calc_at <= now,
-        Trip.calc_state.in_(["idle","done","budget_limited","error"])
-      ).order_by(Trip.next_calc_at.asc()).limit(50)
+        Trip.calc_state.in_(_SCHEDULABLE_STATES)
+      ).order_by(Trip.next_calc_at.asc()).limit(50).with_for_update(skip_locked=True)
     ).all()
 
-    for t in rows:
-      db.execute(update(Trip).where(Trip.id==t.id).values(calc_state="queued", next_calc_at=now + timedelta(seconds=SCAN_INTERVAL_SECONDS)))
-      db.execute(insert(TripUpdate).values(trip_id=t.id, kind="recalc_queued", payload={"by":"scheduler"}))
+    ids = [str(tid) for tid in rows]
+    if rows:
+      next_at = now + timedelta(seconds=SCAN_INTERVAL_SECONDS)
+      db.execute(update(Trip), [{"id": tid, "calc_state": "queued", "next_calc_at": next_at} for tid in rows])
+      db.execute(insert(TripUpdate), [{"trip_id": tid, "kind": "recalc_queued", "payload": {"by":"scheduler"}} for tid in rows])
       db.commit()
-      celery.send_task("worker.tasks.recalc_trip", args=[str(t.id)])
 
-  return {"ok": True, "queued": len(rows)}
+  if ids:
+    group(
+      celery.signature("worker.tasks.recalc_batch", args=[ids[i:i+RECALC_BATCH_SIZE]])
+      for i in range(0, len(ids), RECALC_BATCH_SIZE)
+    ).apply_async()
+
+  return {"ok": True, "queued": len(ids)}
 
 @celery.task(name="worker.tasks.recalc_trip")
 def recalc_trip(trip_id: str):
+  return _run(_recalc(trip_id, asyncio.Semaphore(1)))
+
+@celery.task(name="worker.tasks.recalc_batch")
+def recalc_batch(trip_ids: list[str]):
+  async def _all():
+    # bounds in-flight ORS/OWM requests; per-minute quotas are still enforced by _consume_budget
+    sem = asyncio.Semaphore(RECALC_BATCH_CONCURRENCY)
+    return await asyncio.gather(*[_recalc(tid, sem) for tid in trip_ids], return_exceptions=True)
+
+  results = _run(_all())
+  out = {}
+  for tid, res in zip(trip_ids, results):
+    if isinstance(res, BaseException):
+      logger.error("recalc_batch: trip=%s failed", tid, exc_info=res)
+      res = {"ok": False, "error": str(res)}
+    out[tid] = res
+  return {"ok": True, "results": out}
+
+_RECALC_COLS = [Trip.__table__.c[name] for name in (
+  "id", "deadline_at", "waypoints", "route_distance_m", "route_duration_s", "route_geojson",
+  "policy_mode", "trip_owm_daily_cap", "trip_route_daily_cap", "status",
+)]
+
+_ZSTD = zstandard.ZstdCompressor(level=6)
+_ZSTD_COL_READY = False
+
+def _pack_geom(geom) -> bytes:
+  return _ZSTD.compress(orjson.dumps(geom))
+
+def _has_zstd_col(db) -> bool:
+  # upgraded dbs may not have run infra/sql/003 yet: keep using route_geojson until they do
+  global _ZSTD_COL_READY
+  if not _ZSTD_COL_READY:
+    _ZSTD_COL_READY = db.execute(text(
+      "SELECT 1 FROM information_schema.columns"
+      " WHERE table_schema = current_schema() AND table_name = 'trips' AND column_name = 'route_geojson_zstd'"
+    )).first() is not None
+  return _ZSTD_COL_READY
+
+def _finish(db, tid: uuid.UUID, values: dict, updates: list[dict]) -> bool:
+  # the only write to the trip row per recalc: state + results + scheduling in one statement
+  found = db.execute(update(Trip).where(Trip.id==tid).values(**values).returning(Trip.id)).first() is not None
+  if found:
+    db.execute(insert(TripUpdate), [{"trip_id": tid, **u} for u in updates])
+  db.commit()
+  return found
+
+async def _recalc(trip_id: str, sem: asyncio.Semaphore):
   tid = uuid.UUID(trip_id)
+  try:
+    return await _recalc_trip(tid, sem)
+  except Exception as e:
+    # unexpected (db/redis/decode...): log it and put the trip back into the scan, otherwise it stays queued
+    logger.exception("recalc failed trip=%s", trip_id)
+    now = datetime.now(timezone.utc)
+    with Session() as db:
+      _finish(db, tid, {"calc_state": "error", "next_calc_at": now + timedelta(seconds=RECALC_ERROR_RETRY_SECONDS), "last_calc_at": now},
+              [{"kind": "recalc_error", "payload": {"stage":"unexpected","error":str(e)}}])
+    return {"ok": False, "error": str(e)}
+
+async def _recalc_trip(tid: uuid.UUID, sem: asyncio.Semaphore):
   now = datetime.now(timezone.utc)
 
   with Session() as db:
-    t = db.scalar(select(Trip).where(Trip.id == tid))
+    has_zstd = _has_zstd_col(db)
+    cols = (_RECALC_COLS + [Trip.route_geojson_zstd.isnot(None).label("has_zstd_geom")]) if has_zstd else _RECALC_COLS
+    t = db.execute(select(*cols).where(Trip.id == tid)).first()
     if not t: return {"ok": False, "error":"not-found"}
 
-    db.execute(update(Trip).where(Trip.id==tid).values(calc_state="running"))
-    db.execute(insert(TripUpdate).values(trip_id=tid, kind="recalc_running", payload={"at": now.isoformat()}))
-    db.commit()
-
     points = t.waypoints.get("points") or []
     if len(points) < 2:
-      db.execute(update(Trip).where(Trip.id==tid).values(calc_state="error"))
-      db.execute(insert(TripUpdate).values(trip_id=tid, kind="recalc_error", payload={"stage":"validate","error":"need >=2 points"}))
-      db.commit()
+      _finish(db, tid, {"calc_state": "error"},
+              [{"kind": "recalc_error", "payload": {"stage":"validate","error":"need >=2 points"}}])
       return {"ok": False, "error":"bad-waypoints"}
 
     deadline = t.deadline_at
-    need_route = True if (t.route_duration_s is None or t.route_geojson is None) else False
+    has_geom = (has_zstd and t.has_zstd_geom) or t.route_geojson is not None
+    need_route = True if (t.route_duration_s is None or not has_geom) else False
 
     coords = [[float(p["lon"]), float(p["lat"])] for p in points]
     dest_lat, dest_lon = float(points[-1]["lat"]), float(points[-1]["lon"])
 
     dist_m = t.route_distance_m
     dur_s = t.route_duration_s
-    geom = t.route_geojson
+    geom = None
     provider = "cached"
 
-    if need_route:
+    short_m = haversine_m(*coords[0], *coords[1]) if need_route and len(coords) == 2 else None
+    if short_m is not None and short_m < SHORT_TRIP_MAX_M:
+      # last-mile hop: straight-line estimate, no routing call / budget
+      dist_m, dur_s = int(short_m), int(short_m / SHORT_TRIP_SPEED_MPS)
+      geom, provider = {"type": "LineString", "coordinates": coords}, "haversine"
+    elif need_route and (cached := _route_cache_get(coords)):
+      dist_m, dur_s, geom, provider = cached
+    elif need_route:
       ok, reason = _consume_budget(db, t, "route", "route_calc", 1)
       if not ok:
-        db.execute(update(Trip).where(Trip.id==tid).values(calc_state="budget_limited"))
-        db.execute(insert(TripUpdate).values(trip_id=tid, kind="budget_denied", payload={"api":"route","reason":reason}))
-        db.commit()
         next_s = _next_interval_seconds(t.policy_mode, t.status or "🟡", True)
-        db.execute(update(Trip).where(Trip.id==tid).values(next_calc_at=now + timedelta(seconds=next_s), last_calc_at=now))
-        db.commit()
+        _finish(db, tid, {"calc_state": "budget_limited", "next_calc_at": now + timedelta(seconds=next_s), "last_calc_at": now},
+                [{"kind": "budget_denied", "payload": {"api":"route","reason":reason}}])
         return {"ok": False, "error": "budget_denied_route", "reason": reason}
 
       try:
-        dist_m, dur_s, geom, provider = asyncio.run(_route(coords))
+        async with sem:
+          dist_m, dur_s, geom, provider = await _route(coords)
       except Exception as e:
-        db.execute(update(Trip).where(Trip.id==tid).values(calc_state="error"))
-        db.execute(insert(TripUpdate).values(trip_id=tid, kind="recalc_error", payload={"stage":"route","error":str(e)}))
-        db.commit()
         next_s = _next_interval_seconds(t.policy_mode, t.status or "🟡", False)
-        db.execute(update(Trip).where(Trip.id==tid).values(next_calc_at=now + timedelta(seconds=next_s), last_calc_at=now))
-        db.commit()
+        _finish(db, tid, {"calc_state": "error", "next_calc_at": now + timedelta(seconds=next_s), "last_calc_at": now},
+                [{"kind": "recalc_error", "payload": {"stage":"route","error":str(e)}}])
         return {"ok": False, "error": f"route: {str(e)}"}
 
     eta = now + timedelta(seconds=int(dur_s))
+    updates = []
 
-    ok, reason = _consume_budget(db, t, "owm", "weather_forecast", 1)
-    if not ok:
-      sev, wx = 0.0, {"severity":0.0, "budget_denied": True, "reason": reason}
-      db.execute(insert(TripUpdate).values(trip_id=tid, kind="budget_denied", payload={"api":"owm","reason":reason}))
-      db.commit()
-      budget_limited = True
+    budget_limited = False
+    wx_hit = _forecast_cache_get(dest_lat, dest_lon, eta)
+    if wx_hit:
+      sev, wx = wx_hit
     else:
-      try:
-        sev, wx = asyncio.run(_forecast(dest_lat, dest_lon, eta))
-        budget_limited = False
-      except Exception as e:
-        sev, wx = 0.0, {"severity":0.0, "error": str(e)}
-        budget_limited = False
+      ok, reason = _consume_budget(db, t, "owm", "weather_forecast", 1)
+      if not ok:
+        sev, wx = 0.0, {"severity":0.0, "budget_denied": True, "reason": reason}
+        updates.append({"kind": "budget_denied", "payload": {"api":"owm","reason":reason}})
+        budget_limited = True
+      else:
+        try:
+          async with sem:
+            sev, wx = await _forecast(dest_lat, dest_lon, eta)
+        except Exception as e:
+          sev, wx = 0.0, {"severity":0.0, "error": str(e)}
 
     risk_pct, status, buffer_minutes, why, suggestion = _risk(deadline, eta, sev)
     rec_depart = _recommend_depart(now, status, buffer_minutes)
     cust_msg = _customer_message(status, eta, deadline, why, suggestion)
 
     payload = {
-      "route": {"distance_m": dist_m, "duration_s": dur_s, "geometry": geom, "provider": provider},
+      "route": {"distance_m": dist_m, "duration_s": dur_s, "provider": provider},
       "weather": wx,
       "buffer_minutes": buffer_minutes,
       "computed_at": now.isoformat(),
       "why": why
     }
+    updates.append({"kind": "recalc_done", "payload": payload})
 
     next_s = _next_interval_seconds(t.policy_mode, status, budget_limited)
     next_at = now + timedelta(seconds=next_s)
 
-    with Session() as db2:
-      db2.execute(update(Trip).where(Trip.id==tid).values(
-        eta_at=eta,
-        route_distance_m=dist_m,
-        route_duration_s=dur_s,
-        route_geojson=geom,
-        buffer_minutes=buffer_minutes,
-        delay_risk_pct=risk_pct,
-        status=status,
-        suggestion=suggestion,
-        recommended_depart_at=rec_depart,
-        why=why,
-        customer_message=cust_msg,
-        last_calc_at=now,
-        next_calc_at=next_at,
-        calc_state="budget_limited" if budget_limited else "done",
-      ))
-      db2.execute(insert(TripUpdate).values(trip_id=tid, kind="recalc_done", payload=payload))
-      db2.commit()
+    # geometry is only written when it changed, or to move a legacy JSONB row into the compressed column
+    if provider != "cached":
+      geom_vals = {"route_geojson": None, "route_geojson_zstd": _pack_geom(geom)} if has_zstd else {"route_geojson": geom}
+    elif has_zstd and t.route_geojson is not None:
+      geom_vals = {"route_geojson": None, "route_geojson_zstd": _pack_geom(t.route_geojson)}
+    else:
+      geom_vals = {}
+
+    found = _finish(db, tid, {
+      **geom_vals,
+      "eta_at": eta,
+      "route_distance_m": dist_m,
+      "route_duration_s": dur_s,
+      "buffer_minutes": buffer_minutes,
+      "delay_risk_pct": risk_pct,
+      "status": status,
+      "suggestion": suggestion,
+      "recommended_depart_at": rec_depart,
+      "why": why,
+      "customer_message": cust_msg,
+      "last_calc_at": now,
+      "next_calc_at": next_at,
+      "calc_state": "budget_limited" if budget_limited else "done",
+    }, updates)
+    if not found:
+      return {"ok": False, "error":"not-found"}
 
   return {"ok": True, "risk_pct": risk_pct, "status": status, "budget_limited": budget_limited}